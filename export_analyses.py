@@ -0,0 +1,55 @@
+import argparse
+import sys
+from dotenv import load_dotenv
+
+from routes2 import open_export_cursor, stream_property_analyses, format_export_rows, EXPORT_BATCH_SIZE
+
+# Load environment variables
+load_dotenv()
+
+def export_analyses(output, export_format='csv', neighborhood_code=None, zip_code=None,
+                    min_value=None, max_value=None, batch_size=EXPORT_BATCH_SIZE):
+    """Write adjusted values for every matching property to an open file, one row at a time"""
+    conn, cursor = open_export_cursor(neighborhood_code, zip_code, min_value, max_value)
+    if cursor is None:
+        raise RuntimeError("Could not start export")
+
+    rows = stream_property_analyses(conn, cursor, batch_size)
+    for chunk in format_export_rows(rows, export_format):
+        output.write(chunk)
+
+def positive_int(value):
+    """argparse type for integers greater than zero"""
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be greater than 0, got {value}")
+    return number
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export HCAD property analyses as CSV or NDJSON")
+    parser.add_argument('--format', choices=['csv', 'ndjson'], default='csv')
+    parser.add_argument('--output', help="File to write to (defaults to stdout)")
+    parser.add_argument('--neighborhood-code')
+    parser.add_argument('--zip-code')
+    parser.add_argument('--min-value', type=float, help="Minimum total market value")
+    parser.add_argument('--max-value', type=float, help="Maximum total market value")
+    parser.add_argument('--batch-size', type=positive_int, default=EXPORT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    if args.min_value is not None and args.max_value is not None and args.min_value > args.max_value:
+        parser.error("--min-value cannot be greater than --max-value")
+
+    output = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        export_analyses(
+            output,
+            export_format=args.format,
+            neighborhood_code=args.neighborhood_code,
+            zip_code=args.zip_code,
+            min_value=args.min_value,
+            max_value=args.max_value,
+            batch_size=args.batch_size
+        )
+    finally:
+        if output is not sys.stdout:
+            output.close()
@@ -1,9 +1,16 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query
+from fastapi.responses import StreamingResponse
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import os
+import io
+import csv
+import json
+import time
+from collections import OrderedDict
+from typing import Optional
 from dotenv import load_dotenv
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
 
 # Load environment variables
 load_dotenv()
@@ -43,6 +50,34 @@ EXPANDED_PARAMS = [
     }
 ]
 
+# Number of rows pulled from the server-side cursor per round trip during exports
+EXPORT_BATCH_SIZE = 1000
+
+# Columns written for each account in a bulk export
+EXPORT_COLUMNS = [
+    'account_number',
+    'street_address',
+    'zip_code',
+    'neighborhood_code',
+    'grade',
+    'total_market_value',
+    'num_comps_found',
+    'median_price_per_sqft',
+    'final_adjusted_value'
+]
+
+# Seconds a what-if entry stays cached
+WHAT_IF_CACHE_TTL = 300
+
+# Maximum number of cached neighborhood/grade candidate pools and reference properties
+WHAT_IF_POOL_CACHE_SIZE = 16
+WHAT_IF_PROPERTY_CACHE_SIZE = 256
+
+# LRU caches for what-if analysis: pools keyed by (neighborhood_code, grade), reference properties by account number.
+# Each value is stored as (fetched_at, value)
+what_if_pool_cache = OrderedDict()
+what_if_property_cache = OrderedDict()
+
 # Create router object for API endpoints
 router = APIRouter()
 
@@ -176,20 +211,26 @@ def find_comparable_properties(property_data, ranges):
         print(f'Error finding properties: {e}')
         return None
 
-def find_comps_expanded_params(reference_property):
+def find_comps_expanded_params(reference_property, candidates=None, minimum_comps=MINIMUM_COMPS):
     #Find comparables with progressively wider criteria until minimum count is met
+    #If a candidate pool is given it is filtered in memory instead of queried
+
+    def find_comps(ranges):
+        if candidates is None:
+            return find_comparable_properties(reference_property, ranges)
+        return filter_comparable_properties(reference_property, candidates, ranges)
 
     ranges = calculate_ranges(reference_property, INITIAL_PARAMS)
-    comps = find_comparable_properties(reference_property, ranges)
+    comps = find_comps(ranges)
 
-    if comps and len(comps) >= MINIMUM_COMPS:
+    if comps and len(comps) >= minimum_comps:
         return comps, ranges, "initial"
     
     for i, params in enumerate(EXPANDED_PARAMS, 1):
         ranges = calculate_ranges(reference_property, params)
-        comps = find_comparable_properties(reference_property, ranges)
+        comps = find_comps(ranges)
         
-        if comps and len(comps) >= MINIMUM_COMPS:
+        if comps and len(comps) >= minimum_comps:
             return comps, ranges, f"expansion_{i}"
     
     if comps:
@@ -197,6 +238,14 @@ def find_comps_expanded_params(reference_property):
     
     return None, None, None
     
+def can_be_valued(property_data):
+    #Without building area or CDU there is nothing to value the property against
+    return (
+        convert_to_float(property_data['building_area']) is not None
+        and convert_to_float(property_data['cdu']) is not None
+    )
+
+
 def calculate_adjusted_values(reference_property, comparable_properties):
 
     comp_calculations = []
@@ -232,7 +281,7 @@ def calculate_adjusted_values(reference_property, comparable_properties):
                 'price_per_sqft': float(price_per_sqft)
             })
             
-        except (TypeError, ValueError, ZeroDivisionError) as e:
+        except (TypeError, ValueError, ZeroDivisionError, InvalidOperation) as e:
             print(f"Error processing comparable {comp['account_number']}: {e}")
             continue
     
@@ -243,11 +292,16 @@ def calculate_adjusted_values(reference_property, comparable_properties):
     prices_per_sqft = [calc['price_per_sqft'] for calc in lowest_five]
     median_price_per_sqft = sorted(prices_per_sqft)[len(prices_per_sqft) // 2]
 
-    building_value = median_price_per_sqft * reference_property['building_area']
+    # NUMERIC columns come back as Decimal, convert before mixing with floats
+    reference_building_area = convert_to_float(reference_property['building_area'])
+    land_value = convert_to_float(reference_property['land_value']) or 0
+    extra_features_value = convert_to_float(reference_property['extra_features_value']) or 0
+
+    building_value = median_price_per_sqft * reference_building_area
     final_adjusted_value = (
         building_value +
-        reference_property['land_value'] +
-        reference_property['extra_features_value']
+        land_value +
+        extra_features_value
     )
 
     return {
@@ -256,8 +310,8 @@ def calculate_adjusted_values(reference_property, comparable_properties):
         'final_adjusted_value': final_adjusted_value,
         'value_breakdown': {
             'building_value': building_value,
-            'land_value': reference_property['land_value'],
-            'extra_features_value': reference_property['extra_features_value']
+            'land_value': land_value,
+            'extra_features_value': extra_features_value
         }
     }
 
@@ -335,4 +389,332 @@ async def search_properties(query: str):
             detail=f"No properties found matching '{query}'"
         )
         
-    return properties
\ No newline at end of file
+    return properties
+
+
+def build_export_filters(neighborhood_code=None, zip_code=None, min_value=None, max_value=None):
+    #Build the WHERE clause and its parameters for a bulk export from the given filters
+    conditions = []
+    params = []
+
+    if neighborhood_code:
+        conditions.append("neighborhood_code = %s")
+        params.append(neighborhood_code)
+    if zip_code:
+        conditions.append("zip_code = %s")
+        params.append(zip_code)
+    if min_value is not None:
+        conditions.append("total_market_value >= %s")
+        params.append(min_value)
+    if max_value is not None:
+        conditions.append("total_market_value <= %s")
+        params.append(max_value)
+
+    where_clause = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return where_clause, params
+
+
+def fetch_candidate_pool(conn, neighborhood_code, grade):
+    #Returns every property in a neighborhood and grade using an already open connection
+    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        query = """
+        SELECT *
+        FROM properties
+        WHERE neighborhood_code = %s
+        AND grade = %s;
+        """
+        cursor.execute(query, (neighborhood_code, grade))
+        return cursor.fetchall()
+
+
+def analyze_export_row(reference_property, candidates):
+    #Run the comparable search and valuation for one exported account, keeping the row even if no value can be computed
+    row = {column: reference_property.get(column) for column in EXPORT_COLUMNS}
+    row['num_comps_found'] = 0
+    row['median_price_per_sqft'] = None
+    row['final_adjusted_value'] = None
+
+    if not can_be_valued(reference_property):
+        return row
+
+    comps, ranges, expansion_level = find_comps_expanded_params(reference_property, candidates)
+    if not comps:
+        return row
+
+    try:
+        value_analysis = calculate_adjusted_values(reference_property, comps)
+    except IndexError:
+        # None of the comps had usable values to compute a price per sqft from
+        return row
+
+    row['num_comps_found'] = len(comps)
+    row['median_price_per_sqft'] = value_analysis['median_price_per_sqft']
+    row['final_adjusted_value'] = value_analysis['final_adjusted_value']
+    return row
+
+
+def open_export_cursor(neighborhood_code=None, zip_code=None, min_value=None, max_value=None):
+    #Open a connection and a named (server-side) cursor over the properties to export. Returns (None, None) on failure
+    where_clause, params = build_export_filters(neighborhood_code, zip_code, min_value, max_value)
+
+    conn = get_db_connection()
+    if conn is None:
+        return None, None
+
+    try:
+        cursor = conn.cursor(name='property_export', cursor_factory=RealDictCursor)
+        query = f"""
+        SELECT *
+        FROM properties
+        {where_clause}
+        ORDER BY neighborhood_code, grade, account_number;
+        """
+        cursor.execute(query, params)
+        return conn, cursor
+    except Exception as e:
+        print(f"Error opening export cursor: {e}")
+        conn.close()
+        return None, None
+
+
+def stream_property_analyses(conn, cursor, batch_size=EXPORT_BATCH_SIZE):
+    """Yields an analysis row for every property in an open export cursor.
+
+    Rows are pulled from the server-side cursor one batch at a time. Because the
+    export is sorted by neighborhood and grade, each candidate pool is fetched
+    once over the same connection and comps are filtered from it in memory, so
+    memory is bounded by the largest neighborhood rather than the county.
+    """
+    pool_key = None
+    candidates = []
+
+    try:
+        while True:
+            batch = cursor.fetchmany(batch_size)
+            if not batch:
+                break
+            for reference_property in batch:
+                key = (reference_property['neighborhood_code'], reference_property['grade'])
+                if key != pool_key:
+                    candidates = fetch_candidate_pool(conn, *key)
+                    pool_key = key
+                yield analyze_export_row(reference_property, candidates)
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def json_default(value):
+    #Serialize database values that json can't handle natively
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def format_export_rows(rows, export_format='csv'):
+    #Turn analysis rows into CSV or NDJSON text chunks, one line at a time
+    if export_format == 'ndjson':
+        for row in rows:
+            yield json.dumps(row, default=json_default) + "\n"
+        return
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+@router.get("/api/export")
+def export_property_analyses(
+    format: str = 'csv',
+    neighborhood_code: Optional[str] = None,
+    zip_code: Optional[str] = None,
+    min_value: Optional[float] = None,
+    max_value: Optional[float] = None,
+    batch_size: int = Query(EXPORT_BATCH_SIZE, gt=0)
+):
+    """Stream adjusted values for every property matching the filters as CSV or NDJSON"""
+    if format not in ('csv', 'ndjson'):
+        raise HTTPException(
+            status_code=400,
+            detail="Export format must be 'csv' or 'ndjson'"
+        )
+
+    if min_value is not None and max_value is not None and min_value > max_value:
+        raise HTTPException(
+            status_code=400,
+            detail="min_value cannot be greater than max_value"
+        )
+
+    # Open the cursor before streaming so failures still produce an error status
+    conn, cursor = open_export_cursor(neighborhood_code, zip_code, min_value, max_value)
+    if cursor is None:
+        raise HTTPException(
+            status_code=500,
+            detail="Error occurred while starting the export"
+        )
+
+    rows = stream_property_analyses(conn, cursor, batch_size)
+    media_type = 'text/csv' if format == 'csv' else 'application/x-ndjson'
+
+    return StreamingResponse(
+        format_export_rows(rows, format),
+        media_type=media_type,
+        headers={'Content-Disposition': f'attachment; filename="property_export.{format}"'}
+    )
+
+
+def fetch_candidate_properties(neighborhood_code, grade):
+    #Returns every property in a neighborhood and grade. This is the superset any comp range can draw from
+    try:
+        conn = get_db_connection()
+        candidates = fetch_candidate_pool(conn, neighborhood_code, grade)
+        conn.close()
+        return candidates
+    except Exception as e:
+        print(f'Error fetching candidate properties: {e}')
+        return None
+
+
+def get_cached(cache, key):
+    #Return a fresh cached value and mark it as recently used, dropping it if it has expired
+    entry = cache.get(key)
+    if entry is None:
+        return None
+
+    fetched_at, value = entry
+    if time.time() - fetched_at > WHAT_IF_CACHE_TTL:
+        del cache[key]
+        return None
+
+    cache.move_to_end(key)
+    return value
+
+
+def set_cached(cache, key, value, max_size):
+    #Store a value, evicting the least recently used entries once the cache is full
+    cache[key] = (time.time(), value)
+    cache.move_to_end(key)
+    while len(cache) > max_size:
+        cache.popitem(last=False)
+
+
+def get_what_if_candidates(account_number):
+    #Return the reference property and its candidate pool, only hitting the database when the cached copy is missing or stale
+    reference_property = get_cached(what_if_property_cache, account_number)
+    if reference_property is None:
+        reference_property = get_property_by_account(account_number)
+        if not reference_property:
+            return None, None
+        set_cached(what_if_property_cache, account_number, reference_property, WHAT_IF_PROPERTY_CACHE_SIZE)
+
+    pool_key = (reference_property['neighborhood_code'], reference_property['grade'])
+    candidates = get_cached(what_if_pool_cache, pool_key)
+    if candidates is None:
+        candidates = fetch_candidate_properties(*pool_key)
+        if candidates is None:
+            return reference_property, None
+        set_cached(what_if_pool_cache, pool_key, candidates, WHAT_IF_POOL_CACHE_SIZE)
+
+    return reference_property, candidates
+
+
+def in_range(value, value_range):
+    #Mirror SQL BETWEEN: missing values never match
+    value = convert_to_float(value)
+    if value is None:
+        return False
+    return value_range['min'] <= value <= value_range['max']
+
+
+def filter_comparable_properties(property_data, candidates, ranges):
+    #In-memory equivalent of find_comparable_properties over an already fetched neighborhood/grade candidate pool
+    return [
+        candidate for candidate in candidates
+        if candidate['account_number'] != property_data['account_number']
+        and in_range(candidate['year_built'], ranges['year_range'])
+        and in_range(candidate['building_area'], ranges['building_area_range'])
+        and in_range(candidate['land_area'], ranges['land_area_range'])
+        and in_range(candidate['cdu'], ranges['cdu_range'])
+    ]
+
+
+def try_calculate_adjusted_values(reference_property, comps):
+    #Value the property against the given comps, returning None when there is no usable value
+    if not comps or not can_be_valued(reference_property):
+        return None
+    try:
+        return calculate_adjusted_values(reference_property, comps)
+    except IndexError:
+        # None of the comps had usable values to compute a price per sqft from
+        return None
+
+
+#Re-value a property with custom comp ranges, re-using its cached candidate pool
+#When fewer than minimum_comps match, expanded_analysis holds the widened search the main endpoint would use
+@router.get("/api/property/{account_number}/what-if")
+async def get_what_if_analysis(
+    account_number: str,
+    year_difference: int = Query(INITIAL_PARAMS['YEAR_DIFFERENCE'], ge=0),
+    building_area_percentage: float = Query(INITIAL_PARAMS['BUILDING_AREA_PERCENTAGE'], ge=0, le=100),
+    land_area_percentage: float = Query(INITIAL_PARAMS['LAND_AREA_PERCENTAGE'], ge=0, le=100),
+    cdu_difference: float = Query(INITIAL_PARAMS['CDU_DIFFERENCE'], ge=0),
+    minimum_comps: int = Query(MINIMUM_COMPS, ge=1)
+):
+    params = {
+        'YEAR_DIFFERENCE': year_difference,
+        'BUILDING_AREA_PERCENTAGE': building_area_percentage,
+        'LAND_AREA_PERCENTAGE': land_area_percentage,
+        'CDU_DIFFERENCE': cdu_difference
+    }
+
+    reference_property, candidates = get_what_if_candidates(account_number)
+    if not reference_property:
+        raise HTTPException (
+            status_code=404,
+            detail = f"Property with account number {account_number} not found"
+        )
+
+    if candidates is None:
+        raise HTTPException(
+            status_code=500,
+            detail="Error occurred while fetching comparable properties"
+        )
+
+    ranges = calculate_ranges(reference_property, params)
+    comps = filter_comparable_properties(reference_property, candidates, ranges)
+
+    # Ranges that are too narrow are a normal slider position, not an error
+    meets_minimum_comps = len(comps) >= minimum_comps
+
+    # Below the minimum, also return the progressively expanded search the main endpoint would fall back to
+    expanded_analysis = None
+    if not meets_minimum_comps:
+        expanded_comps, expanded_ranges, expansion_level = find_comps_expanded_params(
+            reference_property, candidates, minimum_comps
+        )
+        expanded_comps = expanded_comps or []
+        expanded_analysis = {
+            'comparable_properties': expanded_comps,
+            'num_comps_found': len(expanded_comps),
+            'search_expansion_level': expansion_level,
+            'value_analysis': try_calculate_adjusted_values(reference_property, expanded_comps)
+        }
+
+    response = {
+        'reference_property': reference_property,
+        'comparable_properties': comps,
+        'num_comps_found': len(comps),
+        'meets_minimum_comps': meets_minimum_comps,
+        'params': params,
+        'value_analysis': try_calculate_adjusted_values(reference_property, comps),
+        'expanded_analysis': expanded_analysis
+    }
+
+    return response
@@ -0,0 +1,76 @@
+import asyncio
+from decimal import Decimal
+
+import routes2
+from routes2 import analyze_export_row
+
+
+def make_property(account_number, building_value=Decimal('200000.00')):
+    return {
+        'account_number': account_number,
+        'street_address': f'{account_number} MAIN ST',
+        'zip_code': '77001',
+        'neighborhood_code': '1000',
+        'grade': 'B',
+        'total_market_value': Decimal('300000.00'),
+        'year_built': 2000,
+        'building_area': Decimal('2000.00'),
+        'land_area': Decimal('6000.00'),
+        'land_value': Decimal('80000.00'),
+        'building_value': building_value,
+        'extra_features_value': Decimal('5000.00'),
+        'cdu': Decimal('0.800'),
+    }
+
+
+def test_export_row_skips_comp_with_null_building_value():
+    reference_property = make_property('0000000000001')
+    candidates = [reference_property, make_property('0000000000002', building_value=None)]
+    candidates += [make_property(f'000000000001{i}') for i in range(5)]
+
+    row = analyze_export_row(reference_property, candidates)
+
+    assert row['account_number'] == '0000000000001'
+    assert row['num_comps_found'] == 6
+    assert row['median_price_per_sqft'] == 97.5
+    assert row['final_adjusted_value'] == 97.5 * 2000 + 80000 + 5000
+
+
+def run_what_if(monkeypatch, reference_property, candidates, **params):
+    monkeypatch.setattr(routes2, 'get_what_if_candidates', lambda account_number: (reference_property, candidates))
+    arguments = {
+        'year_difference': 3,
+        'building_area_percentage': 10,
+        'land_area_percentage': 10,
+        'cdu_difference': 0.1,
+        'minimum_comps': 5,
+    }
+    arguments.update(params)
+    return asyncio.run(routes2.get_what_if_analysis(reference_property['account_number'], **arguments))
+
+
+def test_what_if_without_reference_building_area_has_no_value(monkeypatch):
+    reference_property = make_property('0000000000001')
+    reference_property['building_area'] = None
+    candidates = [make_property(f'000000000001{i}') for i in range(5)]
+
+    response = run_what_if(monkeypatch, reference_property, candidates)
+
+    assert response['num_comps_found'] == 5
+    assert response['value_analysis'] is None
+
+
+def test_what_if_below_minimum_includes_expanded_analysis(monkeypatch):
+    reference_property = make_property('0000000000001')
+    candidates = [make_property(f'000000000001{i}') for i in range(5)]
+    for candidate in candidates:
+        candidate['year_built'] = 2005
+
+    response = run_what_if(monkeypatch, reference_property, candidates, year_difference=1)
+
+    assert response['num_comps_found'] == 0
+    assert response['meets_minimum_comps'] is False
+    assert response['value_analysis'] is None
+    assert response['expanded_analysis']['num_comps_found'] == 5
+    assert response['expanded_analysis']['search_expansion_level'] == 'expansion_1'
+    assert response['expanded_analysis']['value_analysis']['median_price_per_sqft'] == 97.5